@@ -1,8 +1,10 @@
-from sqlalchemy import create_engine, Column, Integer, String, Text
+from sqlalchemy import Column, Integer, String, text
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
 from dotenv import load_dotenv
 from pathlib import Path
+import orjson
 import os
 
 # Load environment variables explicitly from backend/.env
@@ -15,14 +17,28 @@ DATABASE_URL = os.getenv("DATABASE_URL")
 if not DATABASE_URL:
     raise ValueError("❌ DATABASE_URL is missing. Check your .env file.")
 
+# Use the asyncpg driver whatever sync driver the URL names
+for prefix in ("postgresql+psycopg2://", "postgresql://"):
+    if DATABASE_URL.startswith(prefix):
+        DATABASE_URL = "postgresql+asyncpg://" + DATABASE_URL[len(prefix):]
+        break
+
 # Create engine
-engine = create_engine(DATABASE_URL)
+engine = create_async_engine(
+    DATABASE_URL,
+    pool_size=20,
+    max_overflow=10,
+    pool_pre_ping=True,
+    # JSONB columns (Stack.blocks) go through orjson rather than stdlib json
+    json_serializer=lambda obj: orjson.dumps(obj).decode(),
+    json_deserializer=orjson.loads,
+)
 
 # Base class for models
 Base = declarative_base()
 
 # Session factory
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+SessionLocal = async_sessionmaker(bind=engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
 
 # Example table: Stack
 class Stack(Base):
@@ -30,7 +46,43 @@ class Stack(Base):
 
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String(100), nullable=False)
-    blocks = Column(Text, nullable=False)  # Save JSON string of blocks
+    blocks = Column(JSONB, nullable=False, default=dict)
+
+# Converts one legacy TEXT blocks value the way the old Python reader did:
+# empty -> {}, JSON object -> itself, other JSON -> {"value": ...}, invalid JSON -> {"raw": ...}
+_BLOCKS_TO_JSONB_SQL = """
+CREATE FUNCTION pg_temp.blocks_to_jsonb(t text) RETURNS jsonb AS $$
+DECLARE
+    parsed jsonb;
+BEGIN
+    IF t IS NULL OR t = '' THEN
+        RETURN '{}'::jsonb;
+    END IF;
+    BEGIN
+        parsed := t::jsonb;
+    EXCEPTION WHEN others THEN
+        RETURN jsonb_build_object('raw', t);
+    END;
+    IF jsonb_typeof(parsed) = 'object' THEN
+        RETURN parsed;
+    END IF;
+    RETURN jsonb_build_object('value', parsed);
+END;
+$$ LANGUAGE plpgsql
+"""
 
-# Create tables
-Base.metadata.create_all(bind=engine)
+# Create tables (called from the app's startup hook, since the engine is async)
+async def init_db():
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        # One-shot migration: older databases stored blocks as a JSON string in a TEXT column
+        column_type = await conn.scalar(text(
+            "SELECT data_type FROM information_schema.columns "
+            "WHERE table_schema = current_schema() AND table_name = 'stacks' AND column_name = 'blocks'"
+        ))
+        if column_type == "text":
+            await conn.execute(text(_BLOCKS_TO_JSONB_SQL))
+            await conn.execute(text(
+                "ALTER TABLE stacks ALTER COLUMN blocks TYPE JSONB USING pg_temp.blocks_to_jsonb(blocks)"
+            ))
+            await conn.execute(text("DROP FUNCTION pg_temp.blocks_to_jsonb(text)"))
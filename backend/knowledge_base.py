@@ -1,17 +1,33 @@
 """
 Per-stack ChromaDB Knowledge Base for React Flow execution.
 
-- One Chroma collection per stack: knowledge_base_{stack_id}
+- One shared Chroma collection per embedding model: knowledge_base_{model}
+- Chunks are scoped to a stack via their "stack_id" metadata
 - Open-source embeddings (SentenceTransformers)
 - Supports multiple embedding models
+- Optional int8 ONNX Runtime embedders, used when exported under ONNX_DIR:
+    optimum-cli export onnx --model sentence-transformers/all-MiniLM-L6-v2 onnx/minilm
+    optimum-cli onnxruntime quantize --avx512_vnni --onnx_model onnx/minilm -o onnx/minilm-int8
+  (same for all-mpnet-base-v2 -> onnx/mpnet-int8)
 """
 
-from typing import List, Dict, Any, Tuple
+from typing import List, Dict, Any, Tuple, Iterable, Iterator, Union, Optional
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from hashlib import blake2b
+from itertools import islice
 import os
+import re
+import threading
 import chromadb
+import numpy as np
+import torch
 from chromadb.config import Settings
 from sentence_transformers import SentenceTransformer
 
+# Use every available core for the transformer forward pass
+torch.set_num_threads(int(os.getenv("EMBED_NUM_THREADS", os.cpu_count() or 1)))
+
 # ---------- Persistent Chroma store ----------
 CHROMA_DIR = os.getenv("CHROMA_DIR", os.path.join(os.getcwd(), "chroma_db"))
 os.makedirs(CHROMA_DIR, exist_ok=True)
@@ -28,74 +44,336 @@ EMBED_MODELS = {
     # "nomic": "nomic-embed-text-v1",  # optional if you install nomic
 }
 
-# Cache loaded models
-_model_cache: Dict[str, SentenceTransformer] = {}
+# Embedding width per model; used to place legacy per-stack collections in the right shared one
+EMBED_DIMS = {
+    "mini": 384,
+    "mpnet": 768,
+}
+
+# Quantized ONNX exports (see module docstring); models without one use SentenceTransformer
+ONNX_DIR = os.getenv("ONNX_DIR", os.path.join(os.getcwd(), "onnx"))
+ONNX_MODEL_DIRS = {
+    "mini": "minilm-int8",
+    "mpnet": "mpnet-int8",
+}
+# Matches each SentenceTransformer's max_seq_length
+EMBED_MAX_SEQ_LENGTH = {
+    "mini": 256,
+    "mpnet": 384,
+}
+
+# HNSW index settings; Chroma only applies these when a collection is created
+HNSW_METADATA = {
+    "hnsw:space": "cosine",
+    "hnsw:M": 24,
+    "hnsw:construction_ef": 128,
+    "hnsw:search_ef": 100,
+}
+
+# Max texts per forward pass; encode() length-sorts its input so each batch pads tightly.
+# add_to_kb hands it KB_WRITE_BATCH_SIZE texts at a time, so this only caps larger callers.
+EMBED_BATCH_SIZE = 1024
+
+class _OnnxEmbedder:
+    """ONNX Runtime model exposing the subset of SentenceTransformer.encode used here."""
+
+    def __init__(self, path: str, tokenizer_name: str, max_seq_length: int):
+        from optimum.onnxruntime import ORTModelForFeatureExtraction
+        from transformers import AutoTokenizer
+
+        self.tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
+        self.model = ORTModelForFeatureExtraction.from_pretrained(path, file_name="model_quantized.onnx")
+        self.max_seq_length = max_seq_length
+
+    def eval(self) -> "_OnnxEmbedder":
+        return self
+
+    def encode(
+        self,
+        texts: List[str],
+        batch_size: int = 32,
+        show_progress_bar: bool = False,
+        convert_to_numpy: bool = True,
+        normalize_embeddings: bool = False,
+    ) -> np.ndarray:
+        # length-sort like SentenceTransformer so each batch pads tightly
+        order = np.argsort([-len(t) for t in texts], kind="stable")
+        parts = []
+        for start in range(0, len(texts), batch_size):
+            batch = [texts[i] for i in order[start:start + batch_size]]
+            enc = self.tokenizer(
+                batch, padding=True, truncation=True, max_length=self.max_seq_length, return_tensors="np"
+            )
+            hidden = self.model(**enc).last_hidden_state
+            # mean pooling over real (non-padding) tokens
+            mask = enc["attention_mask"][..., None].astype(hidden.dtype)
+            parts.append((hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None))
+        if not parts:
+            return np.empty((0, self.model.config.hidden_size), dtype=np.float32)
+
+        sorted_emb = np.concatenate(parts).astype(np.float32, copy=False)
+        emb = np.empty_like(sorted_emb)
+        emb[order] = sorted_emb
+        if normalize_embeddings:
+            emb /= np.clip(np.linalg.norm(emb, axis=1, keepdims=True), 1e-12, None)
+        return emb
+
+Embedder = Union[SentenceTransformer, _OnnxEmbedder]
+
+# Chunks per embed/write step in add_to_kb; each batch's Chroma write overlaps the next encode
+KB_WRITE_BATCH_SIZE = 256
 
-def _get_embedder(name: str) -> SentenceTransformer:
-    """Load and cache SentenceTransformer model by name key (mini/mpnet)."""
-    if name not in EMBED_MODELS:
-        name = "mini"
-    if name not in _model_cache:
-        _model_cache[name] = SentenceTransformer(EMBED_MODELS[name])
-    return _model_cache[name]
+# Chunk embeddings kept for reuse across uploads: one LRU shared by all models (keys include the model)
+EMBED_CACHE_SIZE = 50_000
 
-def _collection_name(stack_id: int) -> str:
+# Cache loaded models (bounded by EMBED_MODELS since unknown keys fall back to mini)
+_model_cache: Dict[str, Embedder] = {}
+_model_lock = threading.Lock()
+
+# (model key, digest of chunk text) -> embedding
+_embed_cache: "OrderedDict[Tuple[str, str], np.ndarray]" = OrderedDict()
+_embed_cache_lock = threading.Lock()
+
+def _model_key(name: str) -> str:
+    """Map an embed_model argument to a known EMBED_MODELS key, defaulting to mini."""
+    return name if name in EMBED_MODELS else "mini"
+
+def _load_embedder(name: str) -> Embedder:
+    onnx_path = os.path.join(ONNX_DIR, ONNX_MODEL_DIRS[name])
+    if os.path.isdir(onnx_path):
+        # the quantized export doesn't always carry tokenizer files, so take them from the hub model
+        return _OnnxEmbedder(onnx_path, f"sentence-transformers/{EMBED_MODELS[name]}", EMBED_MAX_SEQ_LENGTH[name])
+    return SentenceTransformer(EMBED_MODELS[name])
+
+def _get_embedder(name: str) -> Embedder:
+    """Load and cache the embedder for a name key (mini/mpnet), preferring its ONNX export."""
+    name = _model_key(name)
+    model = _model_cache.get(name)
+    if model is None:
+        with _model_lock:
+            # another request may have loaded it while we waited
+            model = _model_cache.get(name)
+            if model is None:
+                model = _load_embedder(name)
+                model.eval()
+                _model_cache[name] = model
+    return model
+
+def _encode(embedder: Embedder, texts: List[str]) -> np.ndarray:
+    """Embed texts in large length-sorted batches, returning a 2-D array of unit-length vectors."""
+    return embedder.encode(
+        texts,
+        batch_size=EMBED_BATCH_SIZE,
+        show_progress_bar=False,
+        convert_to_numpy=True,
+        normalize_embeddings=True,
+    )
+
+def _encode_cached(embed_model: str, embedder: Embedder, texts: List[str]) -> np.ndarray:
+    """Like _encode, but reuses embeddings of chunks seen before (e.g. boilerplate repeated across PDFs)."""
+    model = _model_key(embed_model)
+    keys = [(model, blake2b(t.encode("utf-8"), digest_size=16).hexdigest()) for t in texts]
+    rows: List[Optional[np.ndarray]] = [None] * len(texts)
+    with _embed_cache_lock:
+        for i, key in enumerate(keys):
+            hit = _embed_cache.get(key)
+            if hit is not None:
+                _embed_cache.move_to_end(key)
+                rows[i] = hit
+
+    misses = [i for i, row in enumerate(rows) if row is None]
+    if misses:
+        # duplicates within this upload are encoded only once
+        first_seen: Dict[Tuple[str, str], int] = {}
+        for i in misses:
+            first_seen.setdefault(keys[i], i)
+        fresh = _encode(embedder, [texts[i] for i in first_seen.values()])
+        computed = {key: vec.copy() for key, vec in zip(first_seen, fresh)}
+        with _embed_cache_lock:
+            for key, vec in computed.items():
+                _embed_cache[key] = vec
+                _embed_cache.move_to_end(key)
+            while len(_embed_cache) > EMBED_CACHE_SIZE:
+                _embed_cache.popitem(last=False)
+        for i in misses:
+            rows[i] = computed[keys[i]]
+    return np.stack(rows)
+
+def _collection_name(embed_model: str) -> str:
+    # models differ in dimension, so each gets its own collection shared by all stacks
+    return f"knowledge_base_{_model_key(embed_model)}"
+
+def _legacy_collection_name(stack_id: int) -> str:
+    """Name of the old one-collection-per-stack layout, kept so clear_kb can drop it."""
     return f"knowledge_base_{stack_id}"
 
-def _get_collection(stack_id: int):
-    return chroma_client.get_or_create_collection(_collection_name(stack_id))
+_LEGACY_COLLECTION_RE = re.compile(r"knowledge_base_(\d+)")
+
+def _new_ids(collection, ids: List[str]) -> List[str]:
+    """Subset of ids not yet stored in the collection (Chroma's add silently skips existing ones)."""
+    existing = set(collection.get(ids=ids, include=[])["ids"])
+    return [i for i in ids if i not in existing]
+
+def _get_collection(embed_model: str):
+    return chroma_client.get_or_create_collection(_collection_name(embed_model), metadata=HNSW_METADATA)
 
 def _chunk_text(text: str, chunk_size: int = 800, overlap: int = 120) -> List[Tuple[str, int, int]]:
     """Split long text into overlapping chunks for embeddings."""
-    chunks = []
     n = len(text)
-    i = 0
-    while i < n:
-        start = i
-        end = min(i + chunk_size, n)
-        chunks.append((text[start:end], start, end))
-        if end == n:
-            break
-        i = max(end - overlap, 0)
-    return chunks
+    if n == 0:
+        return []
+    stride = chunk_size - overlap
+    # ceil((n - chunk_size) / stride) + 1 windows; the last one ends at n
+    count = 1 if n <= chunk_size else -(-(n - chunk_size) // stride) + 1
+    starts = np.arange(count) * stride
+    ends = np.minimum(starts + chunk_size, n)
+    return [(text[s:e], s, e) for s, e in zip(starts.tolist(), ends.tolist())]
+
+def _chunk_pages(pages: Iterable[str], chunk_size: int = 800, overlap: int = 120) -> Iterator[Tuple[str, int, int]]:
+    """Lazily chunk a stream of page texts, carrying the unfinished tail across page boundaries."""
+    buf = ""
+    base = 0
+    for page in pages:
+        buf += page
+        if len(buf) <= chunk_size:
+            continue
+        chunks = _chunk_text(buf, chunk_size, overlap)
+        for chunk, s, e in chunks[:-1]:
+            yield chunk, base + s, base + e
+        # the last chunk may still grow with the next page
+        tail_start = chunks[-1][1]
+        buf = buf[tail_start:]
+        base += tail_start
+    if buf:
+        yield buf, base, base + len(buf)
 
 # ----------------------- Public API -----------------------
 
-def add_to_kb(text: str, stack_id: int, source: str, embed_model: str = "mini") -> Dict[str, Any]:
-    """Chunk text, embed, and store in ChromaDB for given stack."""
+def warm_up(embed_model: str = "mini") -> None:
+    """Load an embedder and run one encode so the first real request skips model load."""
+    _encode(_get_embedder(embed_model), ["warmup"])
+
+def add_to_kb(text: Union[str, Iterable[str]], stack_id: int, source: str, embed_model: str = "mini") -> Dict[str, Any]:
+    """Chunk text (a string or an iterable of page strings), embed, and store in ChromaDB for given stack."""
     try:
-        collection = _get_collection(stack_id)
+        collection = _get_collection(embed_model)
         embedder = _get_embedder(embed_model)
 
-        tuples = _chunk_text(text)
-        documents = [t[0] for t in tuples]
-        metadatas = [
-            {"source": source, "chunk_index": i, "char_start": s, "char_end": e}
-            for i, (_, s, e) in enumerate(tuples)
-        ]
-        ids = [f"{source}:{i}" for i in range(len(documents))]
+        pages = [text] if isinstance(text, str) else text
+        chunks = enumerate(_chunk_pages(pages))
+        added = 0
+        length = 0
+        preview = ""
+        pending: Optional[Future] = None
+        # ids this call wrote; chunks from an earlier upload of the same file are never in here
+        written: List[str] = []
+        try:
+            # one writer thread with at most one add in flight, so batch N is written while N+1 is encoded
+            with ThreadPoolExecutor(max_workers=1) as writer:
+                try:
+                    while True:
+                        batch = list(islice(chunks, KB_WRITE_BATCH_SIZE))
+                        if not batch:
+                            break
+                        if not added:
+                            preview = batch[0][1][0][:500]
+                        added += len(batch)
+                        length = batch[-1][1][2]
+
+                        # Chroma's add skips ids it already has, so only encode and write new chunks
+                        fresh = set(_new_ids(collection, [f"{stack_id}:{source}:{i}" for i, _ in batch]))
+                        batch = [(i, c) for i, c in batch if f"{stack_id}:{source}:{i}" in fresh]
+                        if not batch:
+                            continue
+                        documents = [chunk for _, (chunk, _, _) in batch]
+                        metadatas = [
+                            {"stack_id": stack_id, "source": source, "chunk_index": i, "char_start": s, "char_end": e}
+                            for i, (_, s, e) in batch
+                        ]
+                        ids = [f"{stack_id}:{source}:{i}" for i, _ in batch]
+                        embeddings = _encode_cached(embed_model, embedder, documents)
 
-        if documents:
-            embeddings = embedder.encode(documents, show_progress_bar=False).tolist()
-            collection.add(documents=documents, embeddings=embeddings, metadatas=metadatas, ids=ids)
+                        if pending is not None:
+                            pending.result()
+                        # recorded before submitting so a partially applied add is rolled back too
+                        written.extend(ids)
+                        pending = writer.submit(
+                            collection.add, documents=documents, embeddings=embeddings, metadatas=metadatas, ids=ids
+                        )
+                    if pending is not None:
+                        pending.result()
+                except BaseException:
+                    if pending is not None:
+                        pending.cancel()
+                    raise
+        except Exception:
+            # don't leave part of this upload behind, but keep whatever was stored before it
+            if written:
+                collection.delete(ids=written)
+            raise
 
         return {
-            "chunks_added": len(documents),
-            "preview": documents[0][:500] if documents else "",
+            "chunks_added": added,
+            "length": length,
+            "preview": preview,
         }
     except Exception as e:
         return {"error": str(e)}
 
+def migrate_legacy_collections() -> Dict[str, Any]:
+    """
+    One-shot copy of old knowledge_base_{stack_id} collections into the shared model collections.
+    Stored embeddings are reused (the model is inferred from their width), chunks are tagged with
+    stack_id, and each legacy collection is dropped once copied. Safe to re-run after a crash.
+    """
+    migrated: Dict[str, int] = {}
+    skipped: List[str] = []
+    for coll in chroma_client.list_collections():
+        # newer Chroma releases list names instead of collection objects
+        name = getattr(coll, "name", coll)
+        match = _LEGACY_COLLECTION_RE.fullmatch(name)
+        if not match:
+            continue
+        stack_id = int(match.group(1))
+        legacy = chroma_client.get_collection(name)
+        data = legacy.get(include=["documents", "metadatas", "embeddings"])
+        old_ids = data["ids"]
+        if old_ids:
+            dim = len(data["embeddings"][0])
+            key = next((k for k, d in EMBED_DIMS.items() if d == dim), None)
+            if key is None:
+                # no shared collection of this width; leave it in place rather than lose it
+                skipped.append(name)
+                continue
+            target = _get_collection(key)
+            for j in range(0, len(old_ids), KB_WRITE_BATCH_SIZE):
+                ids = [f"{stack_id}:{i}" for i in old_ids[j:j + KB_WRITE_BATCH_SIZE]]
+                fresh = set(_new_ids(target, ids))
+                rows = [r for r, i in enumerate(ids) if i in fresh]
+                if not rows:
+                    continue
+                target.add(
+                    ids=[ids[r] for r in rows],
+                    documents=[data["documents"][j + r] for r in rows],
+                    embeddings=[data["embeddings"][j + r] for r in rows],
+                    metadatas=[{**(data["metadatas"][j + r] or {}), "stack_id": stack_id} for r in rows],
+                )
+        chroma_client.delete_collection(name)
+        migrated[name] = len(old_ids)
+    return {"migrated": migrated, "skipped": skipped}
+
 def search_kb(query: str, stack_id: int, top_k: int = 4, embed_model: str = "mini") -> List[Dict[str, Any]]:
     """Search knowledge base for a query; returns list of {text, metadata, distance}"""
     try:
-        collection = _get_collection(stack_id)
+        collection = _get_collection(embed_model)
         embedder = _get_embedder(embed_model)
 
-        q_embed = embedder.encode([query], show_progress_bar=False).tolist()[0]
+        # already 2-D: one row for the single query
+        q_embed = _encode(embedder, [query])
         res = collection.query(
-            query_embeddings=[q_embed],
+            query_embeddings=q_embed,
             n_results=top_k,
+            where={"stack_id": stack_id},
             include=["documents", "metadatas", "distances"],
         )
         docs = res.get("documents", [[]])[0]
@@ -110,14 +388,59 @@ def search_kb(query: str, stack_id: int, top_k: int = 4, embed_model: str = "min
         return [{"text": "", "metadata": {}, "distance": 9999, "error": str(e)}]
 
 def clear_kb(stack_id: int) -> Dict[str, Any]:
-    """Clear a stack's collection, then recreate it."""
+    """Delete a stack's chunks from every model collection, dropping any legacy per-stack collection."""
     try:
-        name = _collection_name(stack_id)
+        legacy = _legacy_collection_name(stack_id)
         for coll in chroma_client.list_collections():
-            if coll.name == name:
-                chroma_client.delete_collection(name)
+            if coll.name == legacy:
+                chroma_client.delete_collection(legacy)
                 break
-        chroma_client.get_or_create_collection(name)
-        return {"cleared": True, "collection": name}
+        names = []
+        for key in EMBED_MODELS:
+            _get_collection(key).delete(where={"stack_id": stack_id})
+            names.append(_collection_name(key))
+        return {"cleared": True, "collections": names}
     except Exception as e:
         return {"error": str(e)}
+
+def migrate_legacy_collections() -> Dict[str, Any]:
+    """
+    One-shot copy of old knowledge_base_{stack_id} collections into the shared model collections.
+    Stored embeddings are reused (the model is inferred from their width), chunks are tagged with
+    stack_id, and each legacy collection is dropped once copied. Safe to re-run after a crash.
+    """
+    migrated: Dict[str, int] = {}
+    skipped: List[str] = []
+    for coll in chroma_client.list_collections():
+        # newer Chroma releases list names instead of collection objects
+        name = getattr(coll, "name", coll)
+        match = _LEGACY_COLLECTION_RE.fullmatch(name)
+        if not match:
+            continue
+        stack_id = int(match.group(1))
+        legacy = chroma_client.get_collection(name)
+        data = legacy.get(include=["documents", "metadatas", "embeddings"])
+        old_ids = data["ids"]
+        if old_ids:
+            dim = len(data["embeddings"][0])
+            key = next((k for k, d in EMBED_DIMS.items() if d == dim), None)
+            if key is None:
+                # no shared collection of this width; leave it in place rather than lose it
+                skipped.append(name)
+                continue
+            target = _get_collection(key)
+            for j in range(0, len(old_ids), KB_WRITE_BATCH_SIZE):
+                ids = [f"{stack_id}:{i}" for i in old_ids[j:j + KB_WRITE_BATCH_SIZE]]
+                fresh = set(_new_ids(target, ids))
+                rows = [r for r, i in enumerate(ids) if i in fresh]
+                if not rows:
+                    continue
+                target.add(
+                    ids=[ids[r] for r in rows],
+                    documents=[data["documents"][j + r] for r in rows],
+                    embeddings=[data["embeddings"][j + r] for r in rows],
+                    metadatas=[{**(data["metadatas"][j + r] or {}), "stack_id": stack_id} for r in rows],
+                )
+        chroma_client.delete_collection(name)
+        migrated[name] = len(old_ids)
+    return {"migrated": migrated, "skipped": skipped}
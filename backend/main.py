@@ -1,16 +1,24 @@
 # backend/main.py
-from typing import List, Dict, Any, Optional
-from fastapi import FastAPI, Depends, HTTPException, File, UploadFile
+from typing import List, Dict, Any, Optional, Set, Tuple, AsyncIterator, BinaryIO
+from fastapi import FastAPI, Depends, HTTPException, File, UploadFile, Query
 from pydantic import BaseModel, Field
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse
 
-from backend.database import SessionLocal, Stack
-from backend.knowledge_base import add_to_kb, search_kb, clear_kb
-
-import requests
-import json
+from backend.database import SessionLocal, Stack, init_db
+from backend.knowledge_base import add_to_kb, search_kb, clear_kb, warm_up, migrate_legacy_collections
+
+from collections import defaultdict
+import httpx
+import orjson
+import os
+import shutil
+import tempfile
+import threading
+import time
 import fitz  # PyMuPDF
 
 app = FastAPI(
@@ -19,6 +27,19 @@ app = FastAPI(
     version="2.1.0",
 )
 
+# Shared keep-alive client for the local Ollama server
+ollama_client = httpx.AsyncClient(
+    base_url="http://localhost:11434",
+    timeout=httpx.Timeout(300, connect=5),
+    limits=httpx.Limits(max_connections=32, max_keepalive_connections=10),
+)
+
+# Models Ollama reported via /api/tags, refreshed at most every TTL seconds
+AVAILABLE_MODELS_TTL = 60.0
+_available_models: Set[str] = set()
+_available_models_at = float("-inf")
+_available_models_lock = threading.Lock()
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["http://localhost:3000", "http://127.0.0.1:3000"],
@@ -28,13 +49,30 @@ app.add_middleware(
 )
 
 
+@app.on_event("startup")
+async def create_tables():
+    await init_db()
+
+
+@app.on_event("startup")
+def migrate_knowledge_base():
+    migrate_legacy_collections()
+
+
+@app.on_event("startup")
+def warm_up_embedder():
+    warm_up("mini")
+
+
+@app.on_event("shutdown")
+async def close_ollama_client():
+    await ollama_client.aclose()
+
+
 # ----------------- DB dependency -----------------
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 
 # ----------------- Pydantic models -----------------
@@ -53,6 +91,13 @@ class StackResponse(BaseModel):
         orm_mode = True
 
 
+class StackSummary(BaseModel):
+    id: int
+    name: str
+    # first node's value, shown on the stack card
+    preview: Optional[str] = None
+
+
 class RFNode(BaseModel):
     id: str
     type: str
@@ -85,7 +130,7 @@ def _normalize_blocks_input(blocks_input: Any) -> Dict[str, Any]:
       - a Python dict (already parsed)
       - a JSON string (e.g. frontend did JSON.stringify)
       - anything else -> wrap into {"raw": str(...)}
-    Returns a Python dict safe to json.dumps and store.
+    Returns a Python dict safe to serialize and store.
     """
     if blocks_input is None:
         return {}
@@ -95,7 +140,7 @@ def _normalize_blocks_input(blocks_input: Any) -> Dict[str, Any]:
     # If it's a string, try to parse as JSON
     if isinstance(blocks_input, str):
         try:
-            parsed = json.loads(blocks_input)
+            parsed = orjson.loads(blocks_input)
             if isinstance(parsed, dict):
                 return parsed
             # if parsed JSON is not a dict, wrap it
@@ -110,19 +155,6 @@ def _normalize_blocks_input(blocks_input: Any) -> Dict[str, Any]:
     return {"raw": str(blocks_input)}
 
 
-def _parse_blocks_from_db(blocks_text: Optional[str]) -> Dict[str, Any]:
-    if not blocks_text:
-        return {}
-    try:
-        parsed = json.loads(blocks_text)
-        if isinstance(parsed, dict):
-            return parsed
-        return {"value": parsed}
-    except Exception:
-        # if stored value is not valid JSON (unexpected), return raw
-        return {"raw": blocks_text}
-
-
 # ----------------- Root -----------------
 @app.get("/")
 def read_root():
@@ -131,57 +163,67 @@ def read_root():
 
 # ---------------- stacks CRUD ----------------
 @app.post("/stacks/", response_model=StackResponse)
-def create_stack(stack: StackCreate, db: Session = Depends(get_db)):
+async def create_stack(stack: StackCreate, db: AsyncSession = Depends(get_db)):
     # Normalize blocks input (accept string or object)
     normalized = _normalize_blocks_input(stack.blocks)
-    db_stack = Stack(name=stack.name, blocks=json.dumps(normalized))
+    db_stack = Stack(name=stack.name, blocks=normalized)
     db.add(db_stack)
-    db.commit()
-    db.refresh(db_stack)
+    await db.commit()
+    await db.refresh(db_stack)
 
     return {"id": db_stack.id, "name": db_stack.name, "blocks": normalized}
 
 
-@app.get("/stacks/", response_model=List[StackResponse])
-def get_stacks(db: Session = Depends(get_db)):
-    rows = db.query(Stack).all()
-    out: List[Dict[str, Any]] = []
-    for s in rows:
-        blocks_parsed = _parse_blocks_from_db(s.blocks)
-        out.append({"id": s.id, "name": s.name, "blocks": blocks_parsed})
-    return out
+@app.get("/stacks/", response_model=List[StackSummary])
+async def get_stacks(
+    limit: int = Query(50, ge=1, le=500),
+    offset: Optional[int] = Query(None, ge=0),
+    after_id: Optional[int] = None,
+    db: AsyncSession = Depends(get_db),
+):
+    if offset is not None and after_id is not None:
+        raise HTTPException(status_code=400, detail="Pass either 'offset' or 'after_id', not both")
+    # blocks stay in the database; only the card preview is extracted from the JSONB
+    preview = Stack.blocks[("nodes", 0, "data", "value")].astext
+    stmt = select(Stack.id, Stack.name, preview.label("preview")).order_by(Stack.id).limit(limit)
+    if after_id is not None:
+        # keyset paging: pass the last id of the previous page
+        stmt = stmt.where(Stack.id > after_id)
+    elif offset:
+        stmt = stmt.offset(offset)
+    rows = await db.execute(stmt)
+    return [{"id": r.id, "name": r.name, "preview": r.preview} for r in rows]
 
 
 @app.get("/stacks/{stack_id}", response_model=StackResponse)
-def get_stack(stack_id: int, db: Session = Depends(get_db)):
-    stack = db.query(Stack).filter(Stack.id == stack_id).first()
+async def get_stack(stack_id: int, db: AsyncSession = Depends(get_db)):
+    stack = await db.get(Stack, stack_id)
     if not stack:
         raise HTTPException(status_code=404, detail="Stack not found")
-    blocks_parsed = _parse_blocks_from_db(stack.blocks)
-    return {"id": stack.id, "name": stack.name, "blocks": blocks_parsed}
+    return {"id": stack.id, "name": stack.name, "blocks": stack.blocks}
 
 
 @app.put("/stacks/{stack_id}", response_model=StackResponse)
-def update_stack(stack_id: int, stack: StackCreate, db: Session = Depends(get_db)):
-    db_stack = db.query(Stack).filter(Stack.id == stack_id).first()
+async def update_stack(stack_id: int, stack: StackCreate, db: AsyncSession = Depends(get_db)):
+    db_stack = await db.get(Stack, stack_id)
     if not db_stack:
         raise HTTPException(status_code=404, detail="Stack not found")
 
     normalized = _normalize_blocks_input(stack.blocks)
     db_stack.name = stack.name
-    db_stack.blocks = json.dumps(normalized)
-    db.commit()
-    db.refresh(db_stack)
+    db_stack.blocks = normalized
+    await db.commit()
+    await db.refresh(db_stack)
     return {"id": db_stack.id, "name": db_stack.name, "blocks": normalized}
 
 
 @app.delete("/stacks/{stack_id}")
-def delete_stack(stack_id: int, db: Session = Depends(get_db)):
-    stack = db.query(Stack).filter(Stack.id == stack_id).first()
+async def delete_stack(stack_id: int, db: AsyncSession = Depends(get_db)):
+    stack = await db.get(Stack, stack_id)
     if not stack:
         raise HTTPException(status_code=404, detail="Stack not found")
-    db.delete(stack)
-    db.commit()
+    await db.delete(stack)
+    await db.commit()
     return {"message": f"Stack {stack_id} deleted successfully"}
 
 
@@ -191,17 +233,17 @@ async def upload_file(stack_id: int, file: UploadFile = File(...), embed_model:
     if not file.filename.lower().endswith(".pdf"):
         raise HTTPException(status_code=400, detail="Only PDF files are supported")
     try:
-        content = await file.read()
-        doc = fitz.open(stream=content, filetype="pdf")
-        text = "".join([page.get_text() for page in doc])
-        doc.close()
+        await file.seek(0)
+        # spooling, parsing and embedding all block, so keep them off the event loop
+        stats = await run_in_threadpool(_ingest_pdf, file.file, stack_id, file.filename, embed_model)
+        if "error" in stats:
+            raise RuntimeError(stats["error"])
 
-        stats = add_to_kb(text=text, stack_id=stack_id, source=file.filename, embed_model=embed_model)
-        # stats expected: {"chunks_added": int, "preview": str}
+        # stats expected: {"chunks_added": int, "length": int, "preview": str}
         return {
             "filename": file.filename,
             "preview": stats.get("preview", ""),
-            "length": len(text),
+            "length": stats.get("length", 0),
             "chunks_added": stats.get("chunks_added", 0),
         }
     except Exception as e:
@@ -215,12 +257,12 @@ def clear_knowledge_base_route(stack_id: int):
 
 # ---------------- execute graph ----------------
 @app.post("/execute")
-def execute(req: ExecuteRequest):
+async def execute(req: ExecuteRequest):
     _ = build(BuildRequest(nodes=req.nodes, edges=req.edges))
     nodes_by_id = {n.id: n for n in req.nodes}
-    adj: Dict[str, List[str]] = {e.source: [] for e in req.edges}
+    adj: Dict[str, List[str]] = defaultdict(list)
     for e in req.edges:
-        adj.setdefault(e.source, []).append(e.target)
+        adj[e.source].append(e.target)
 
     query_id = next((n.id for n in req.nodes if n.type == "query"), None)
     output_id = next((n.id for n in req.nodes if n.type == "output"), None)
@@ -231,21 +273,21 @@ def execute(req: ExecuteRequest):
     if not path:
         raise HTTPException(status_code=400, detail="Could not determine execution path")
 
-    def generate():
+    async def generate():
         assistantText = ""
         try:
             user_query = req.query or nodes_by_id[query_id].data.get("value", "")
             if not user_query:
-                yield json.dumps({"type": "error", "message": "Missing user query"}) + "\n"
+                yield orjson.dumps({"type": "error", "message": "Missing user query"}) + b"\n"
                 return
 
             if req.stream_logs:
-                yield json.dumps({"type": "status", "message": f"Path: {' → '.join(path)}"}) + "\n"
+                yield orjson.dumps({"type": "status", "message": f"Path: {' → '.join(path)}"}) + b"\n"
 
             # ---- LLM Node ----
             llm_node_id = next((nid for nid in path if nodes_by_id[nid].type == "llm"), None)
             if not llm_node_id:
-                yield json.dumps({"type": "error", "message": "No LLM node"}) + "\n"
+                yield orjson.dumps({"type": "error", "message": "No LLM node"}) + b"\n"
                 return
 
             llm_node = nodes_by_id[llm_node_id]
@@ -255,20 +297,21 @@ def execute(req: ExecuteRequest):
             prompt = f"{system_prompt}\n\nUser: {user_query}\n"
 
             # stream tokens
-            for ev in _stream_ollama(model=model, prompt=prompt):
-                data = json.loads(ev)
-                if data["type"] == "token":
-                    assistantText += data["message"]
-                yield ev
+            async for ev_type, message in _stream_ollama(model=model, prompt=prompt):
+                if ev_type == "token":
+                    assistantText += message
+                yield orjson.dumps({"type": ev_type, "message": message}) + b"\n"
+                if ev_type == "error":
+                    return
 
             # ✅ Final assistant output event
-            yield json.dumps({"type": "output", "message": assistantText}) + "\n"
+            yield orjson.dumps({"type": "output", "message": assistantText}) + b"\n"
 
             if req.stream_logs:
-                yield json.dumps({"type": "done", "message": "Execution finished"}) + "\n"
+                yield orjson.dumps({"type": "done", "message": "Execution finished"}) + b"\n"
 
         except Exception as e:
-            yield json.dumps({"type": "error", "message": str(e)}) + "\n"
+            yield orjson.dumps({"type": "error", "message": str(e)}) + b"\n"
 
     return StreamingResponse(generate(), media_type="application/x-ndjson")
 # ---------------- helpers ----------------
@@ -281,15 +324,54 @@ def build(req: BuildRequest):
     return {"ok": True}
 
 
+def _pdf_path(src: BinaryIO) -> Tuple[str, bool]:
+    """
+    Return a filesystem path for an upload and whether it is a temp copy the caller must remove.
+    Starlette's SpooledTemporaryFile is already on disk once it rolls over (>1 MB); where /proc
+    exposes its descriptor that file is opened directly, otherwise the upload is copied in blocks.
+    """
+    if getattr(src, "_rolled", False):
+        fd_path = f"/proc/self/fd/{src.fileno()}"
+        if os.path.exists(fd_path):
+            return fd_path, False
+
+    src.seek(0)
+    tmp = tempfile.NamedTemporaryFile(suffix=".pdf", delete=False)
+    try:
+        with tmp:
+            shutil.copyfileobj(src, tmp, 1024 * 1024)
+    except BaseException:
+        os.remove(tmp.name)
+        raise
+    return tmp.name, True
+
+
+def _ingest_pdf(src: BinaryIO, stack_id: int, source: str, embed_model: str) -> Dict[str, Any]:
+    """Open an uploaded PDF from disk and add its text to the stack's KB (blocking)."""
+    path, is_copy = _pdf_path(src)
+    try:
+        # opened from a path, MuPDF reads pages on demand instead of holding the whole file
+        doc = fitz.open(path, filetype="pdf")
+        try:
+            # pages are extracted lazily while add_to_kb chunks them
+            pages = (page.get_text("text") for page in doc)
+            return add_to_kb(text=pages, stack_id=stack_id, source=source, embed_model=embed_model)
+        finally:
+            doc.close()
+    finally:
+        if is_copy:
+            os.remove(path)
+
+
 def _greedy_path(start: str, goal: str, adj: Dict[str, List[str]]) -> List[str]:
     path = [start]
     cur = start
     visited = {cur}
     while cur != goal:
-        nxts = [n for n in adj.get(cur, []) if n not in visited]
-        if not nxts:
+        # first unvisited neighbour, without building the full candidate list
+        cur = next((n for n in adj.get(cur, ()) if n not in visited), None)
+        if cur is None:
             return []
-        cur = nxts[0]
         path.append(cur)
         visited.add(cur)
         if len(path) > 256:
@@ -297,44 +379,88 @@ def _greedy_path(start: str, goal: str, adj: Dict[str, List[str]]) -> List[str]:
     return path
 
 
-def _stream_ollama(model: str, prompt: str):
-    # Ensure model present
+def _model_tag(model: str) -> str:
+    """Ollama lists untagged models as "<name>:latest"; normalize so both spellings compare equal."""
+    return model if ":" in model else f"{model}:latest"
+
+
+async def _ollama_error(resp: httpx.Response) -> str:
+    """Error message from a non-2xx streamed Ollama response."""
+    body = await resp.aread()
+    try:
+        return orjson.loads(body).get("error") or f"HTTP {resp.status_code}"
+    except Exception:
+        return body.decode("utf-8", "replace") or f"HTTP {resp.status_code}"
+
+
+async def _model_available(model: str) -> bool:
+    """Check the cached /api/tags result, refreshing it on a miss or once the TTL expires."""
+    global _available_models_at
+    tag = _model_tag(model)
+    with _available_models_lock:
+        fresh = time.monotonic() - _available_models_at < AVAILABLE_MODELS_TTL
+        if fresh and tag in _available_models:
+            return True
+
     try:
-        resp = requests.get("http://localhost:11434/api/tags", timeout=10)
-        available = [m["name"] for m in resp.json().get("models", [])]
+        resp = await ollama_client.get("/api/tags", timeout=10)
+        names = {_model_tag(m["name"]) for m in resp.json().get("models", [])}
     except Exception:
-        available = []
-
-    if model not in available:
-        pull_resp = requests.post(
-            "http://localhost:11434/api/pull",
-            json={"name": model},
-            stream=True,
-            timeout=60,
-        )
-        for line in pull_resp.iter_lines():
+        return False
+
+    with _available_models_lock:
+        _available_models.clear()
+        _available_models.update(names)
+        _available_models_at = time.monotonic()
+        return tag in _available_models
+
+
+async def _stream_ollama(model: str, prompt: str) -> AsyncIterator[Tuple[str, str]]:
+    """
+    Yield (type, message) events: "status" while pulling the model, then one "token" per chunk.
+    A failed pull or generation yields a single "error" event and ends the stream.
+    """
+    # Ensure model present
+    if not await _model_available(model):
+        pulled = False
+        async with ollama_client.stream("POST", "/api/pull", json={"name": model}, timeout=60) as pull_resp:
+            if pull_resp.status_code != 200:
+                yield "error", f"Pulling {model} failed: {await _ollama_error(pull_resp)}"
+                return
+            async for line in pull_resp.aiter_lines():
+                if not line:
+                    continue
+                try:
+                    status = orjson.loads(line)
+                except Exception:
+                    continue
+                if "error" in status:
+                    yield "error", f"Pulling {model} failed: {status['error']}"
+                    return
+                if "status" in status:
+                    pulled = pulled or status["status"] == "success"
+                    yield "status", f"Pulling {model}: {status['status']}"
+        if not pulled:
+            yield "error", f"Pulling {model} did not complete"
+            return
+        # only a completed pull marks the model available
+        with _available_models_lock:
+            _available_models.add(_model_tag(model))
+        yield "status", f"Model {model} ready"
+
+    async with ollama_client.stream("POST", "/api/generate", json={"model": model, "prompt": prompt}) as gen_resp:
+        if gen_resp.status_code != 200:
+            yield "error", await _ollama_error(gen_resp)
+            return
+        async for line in gen_resp.aiter_lines():
             if not line:
                 continue
             try:
-                status = json.loads(line.decode("utf-8"))
-                if "status" in status:
-                    yield json.dumps({"type": "status", "message": f"Pulling {model}: {status['status']}"}) + "\n"
+                chunk = orjson.loads(line)
             except Exception:
-                pass
-        yield json.dumps({"type": "status", "message": f"Model {model} ready"}) + "\n"
-
-    gen_resp = requests.post(
-        "http://localhost:11434/api/generate",
-        json={"model": model, "prompt": prompt},
-        stream=True,
-        timeout=300,
-    )
-    for line in gen_resp.iter_lines():
-        if not line:
-            continue
-        try:
-            chunk = json.loads(line.decode("utf-8"))
+                continue
+            if "error" in chunk:
+                yield "error", chunk["error"]
+                return
             if "response" in chunk:
-                yield json.dumps({"type": "token", "message": chunk["response"]}) + "\n"
-        except Exception:
-            continue
+                yield "token", chunk["response"]
@@ -2,6 +2,9 @@
 import React, { useEffect, useState } from "react";
 import axios from "axios";
 
+// stacks fetched per request; the list endpoint caps each page
+const PAGE_SIZE = 100;
+
 function Home({ onNewStack, onOpenStack }) {
   const [stacks, setStacks] = useState([]);
   const [loading, setLoading] = useState(true);
@@ -10,8 +13,18 @@ function Home({ onNewStack, onOpenStack }) {
   useEffect(() => {
     const fetchStacks = async () => {
       try {
-        const response = await axios.get("http://127.0.0.1:8000/stacks/");
-        setStacks(response.data);
+        // keyset paging: keep asking for ids after the last one until a short page comes back
+        let all = [];
+        let afterId = null;
+        while (true) {
+          const params = { limit: PAGE_SIZE };
+          if (afterId !== null) params.after_id = afterId;
+          const response = await axios.get("http://127.0.0.1:8000/stacks/", { params });
+          all = all.concat(response.data);
+          if (response.data.length < PAGE_SIZE) break;
+          afterId = response.data[response.data.length - 1].id;
+        }
+        setStacks(all);
       } catch (err) {
         setError("Unable to load stacks. Please try again.");
         console.error(err);
@@ -47,12 +60,7 @@ function Home({ onNewStack, onOpenStack }) {
       ) : (
         <div className="grid grid-cols-1 md:grid-cols-2 gap-4">
           {stacks.map((stack) => {
-            let preview = "";
-            if (stack.blocks?.nodes?.length > 0) {
-              preview = stack.blocks.nodes[0].data?.value || "";
-            } else {
-              preview = "No preview available";
-            }
+            const preview = stack.preview || "No preview available";
 
             return (
               <div